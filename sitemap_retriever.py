@@ -9,23 +9,54 @@ in common locations, parses robots.txt files, and attempts to find sitemap refer
 in the website's HTML.
 
 Usage:
-    python sitemap_retriever.py [-h] [-t THRESHOLD] url
+    python sitemap_retriever.py [-h] [-t THRESHOLD] [-c] [-f FORMAT] [-d MAX_DEPTH]
+                                [-w WORKERS] url
 
 Arguments:
     url         The base URL of the website to check for sitemaps
     -t, --threshold THRESHOLD
                 Maximum number of URLs to display per sitemap (default: 50)
+    -c, --cache
+                Cache responses in .sitemap_cache.sqlite and revalidate them on reruns
+    -f, --format {text,json,ndjson}
+                Output format; json and ndjson list every URL, ignoring the
+                threshold (default: text)
+    -d, --max-depth MAX_DEPTH
+                Levels of nested sitemap indexes to follow (default: 3, 0 disables)
+    -w, --workers WORKERS
+                Processes used to fetch and parse child sitemaps, at most 5 so
+                the per-host request budget is kept (default: 1)
     -h, --help  Show this help message and exit
 """
 
 import requests
-import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import argparse
+import itertools
 import logging
-from typing import List, Dict, Union
+import multiprocessing
+import orjson
+import re
+import sys
+import threading
+import time
+from functools import partial
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Iterable, Iterator, List, Dict, Optional, Tuple, Union
 from urllib.parse import urljoin, urlparse
-from xml.etree import ElementTree as ET
-import gzip
+from lxml import etree as ET
+import zlib
+
+try:
+    from requests_cache import CachedSession
+except ImportError:
+    CachedSession = None
+
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
 
 SITEMAP_INDICATORS = [
     "sitemap.xml",
@@ -36,132 +67,415 @@ SITEMAP_INDICATORS = [
     "robots.txt",
 ]
 
+# Upper bound on in-flight requests so probing stays polite to the target host
+MAX_CONCURRENT_REQUESTS = 5
+
+# Per-host request budget; bursts below it go out without waiting
+MAX_REQUESTS_PER_HOST = 5
+RATE_LIMIT_PERIOD = 1.0
+
+# How many levels of nested sitemap indexes are followed by default
+MAX_DEPTH = 3
+
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+
+# Sitemaps are downloaded and parsed incrementally in blocks of this size
+CHUNK_SIZE = 64 * 1024
+
+SITEMAP_NAMESPACE = "http://www.sitemaps.org/schemas/sitemap/0.9"
+_LOC_TAG = f"{{{SITEMAP_NAMESPACE}}}loc"
+_SITEMAPINDEX_TAG = f"{{{SITEMAP_NAMESPACE}}}sitemapindex"
+_URLSET_TAG = f"{{{SITEMAP_NAMESPACE}}}urlset"
+
+_ROBOTS_SITEMAP_RE = re.compile(r"(?im)^[ \t]*sitemap:[ \t]*(\S+)")
+
+# Absolute or relative references whose path ends in one of SITEMAP_INDICATORS,
+# keeping any query or fragment; longer names go first so "sitemap.xml.gz" is
+# not cut short at "sitemap.xml", and "sitemap.xml.bak" does not match at all
+_HTML_SITEMAP_RE = re.compile(
+    r"""[^\s"'<>=?#]*(?:"""
+    + "|".join(map(re.escape, sorted(SITEMAP_INDICATORS, key=len, reverse=True)))
+    + r""")(?=[?#\s"'<>]|$)(?:[?#][^\s"'<>]*)?"""
+)
+
+CACHE_NAME = ".sitemap_cache"
+# Cached responses are revalidated with ETag/Last-Modified once this old
+CACHE_EXPIRE_AFTER = 3600
+
+HEADERS = {
+    "User-Agent": "SitemapRetriever/1.0 (+https://github.com/yourusername/sitemap-retriever)"
+}
+
+
+def build_session(cache_name: Optional[str] = None) -> requests.Session:
+    if cache_name:
+        if CachedSession is None:
+            raise ImportError("response caching requires requests-cache")
+        session = CachedSession(
+            cache_name, backend="sqlite", expire_after=CACHE_EXPIRE_AFTER
+        )
+    else:
+        session = requests.Session()
+    session.headers.update(HEADERS)
+    adapter = HTTPAdapter(
+        pool_connections=20,
+        pool_maxsize=20,
+        max_retries=Retry(
+            total=3,
+            status_forcelist=[429, 500, 502, 503, 504],
+            backoff_factor=0.2,
+            raise_on_status=False,
+        ),
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+_SESSION = build_session()
+
+
+def get_session() -> requests.Session:
+    return _SESSION
+
+
+def set_session(session: requests.Session) -> None:
+    global _SESSION
+    _SESSION = session
+
+
+class RateLimiter:
+    """Thread-safe token bucket allowing max_rate acquisitions per time_period."""
+
+    def __init__(self, max_rate: float, time_period: float) -> None:
+        self.max_rate = max_rate
+        self.time_period = time_period
+        # A budget below one request per period still has to let one through
+        self._capacity = max(1.0, max_rate)
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                refill = (now - self._updated) * self.max_rate / self.time_period
+                self._tokens = min(self._capacity, self._tokens + refill)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                time.sleep((1 - self._tokens) * self.time_period / self.max_rate)
+
+
+# Requests per host per period allowed to this process; worker processes get
+# their share of MAX_REQUESTS_PER_HOST from init_worker
+_requests_per_host: float = MAX_REQUESTS_PER_HOST
+
+_RATE_LIMITERS: Dict[str, RateLimiter] = {}
+_RATE_LIMITERS_LOCK = threading.Lock()
+
+
+def get_rate_limiter(url: str) -> RateLimiter:
+    host = urlparse(url).netloc
+    with _RATE_LIMITERS_LOCK:
+        if host not in _RATE_LIMITERS:
+            _RATE_LIMITERS[host] = RateLimiter(_requests_per_host, RATE_LIMIT_PERIOD)
+        return _RATE_LIMITERS[host]
+
+
+def fetch(url: str, method: str = "GET", **kwargs) -> requests.Response:
+    get_rate_limiter(url).acquire()
+    return get_session().request(method, url, **kwargs)
+
 
 def get_sitemaps_from_url(
-    base_url: str, threshold: int
+    base_url: str, threshold: int, max_depth: int = MAX_DEPTH, workers: int = 1
 ) -> List[Dict[str, Union[str, Dict[str, List[str]]]]]:
-    headers = {
-        "User-Agent": "SitemapRetriever/1.0 (+https://github.com/yourusername/sitemap-retriever)"
-    }
-
-    session = requests.Session()
-    all_results = []
-
-    for spath in SITEMAP_INDICATORS:
-        full_path = urljoin(base_url, spath)
-        logging.info(f"Checking {full_path}")
-        try:
-            response = session.get(
-                full_path, headers=headers, allow_redirects=True, timeout=10
+    # Fallback origin for probes that get a 403, shared by every probe
+    parsed_base = urlparse(base_url)
+    alt_scheme = "https" if parsed_base.scheme == "http" else "http"
+    alt_base_url = f"{alt_scheme}://{parsed_base.netloc}"
+
+    # Parsed sitemaps for this run, keyed by both requested and post-redirect URL
+    cache: Dict[str, Tuple[str, Dict[str, Union[str, List[str]]]]] = {}
+
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+        candidates = executor.map(
+            lambda spath: probe_sitemap_path(base_url, alt_base_url, spath),
+            SITEMAP_INDICATORS,
+        )
+
+        # Probes often redirect to the same resource, and an index already
+        # lists every sitemap, so only robots.txt is still worth reading then
+        all_results = []
+        seen_finals = set()
+        found_index = False
+        for spath, sitemap_urls in zip(SITEMAP_INDICATORS, candidates):
+            if found_index and spath != "robots.txt":
+                continue
+            sitemap_urls = [
+                url for url in dict.fromkeys(sitemap_urls) if url not in seen_finals
+            ]
+            seen_finals.update(sitemap_urls)
+            results = fetch_sitemaps(sitemap_urls, executor, cache)
+            found_index = found_index or any(
+                result["content"]["type"] == "index" for result in results
             )
-            logging.info(f"Got response {response.status_code}")
-
-            if response.status_code == 200:
-                if spath == "robots.txt":
-                    sitemap_urls = parse_robots_txt(response.text)
-                    for sitemap_url in sitemap_urls:
-                        result = get_sitemap_content(sitemap_url, session, headers)
-                        if result:
-                            all_results.append({"url": sitemap_url, "content": result})
-                else:
-                    result = get_sitemap_content(full_path, session, headers)
-                    if result:
-                        all_results.append({"url": full_path, "content": result})
-            elif response.status_code == 403:
-                alt_scheme = "https" if urlparse(base_url).scheme == "http" else "http"
-                alt_base_url = f"{alt_scheme}://{urlparse(base_url).netloc}"
-                alt_full_path = urljoin(alt_base_url, spath)
-                logging.info(f"Trying alternative protocol: {alt_full_path}")
-                alt_response = session.get(
-                    alt_full_path, headers=headers, allow_redirects=True, timeout=10
+            all_results.extend(results)
+
+        if not all_results:
+            try:
+                homepage_response = fetch(base_url, allow_redirects=True, timeout=10)
+                if homepage_response.status_code == 200:
+                    sitemap_urls = find_sitemaps_in_html(
+                        homepage_response.text, base_url
+                    )
+                    all_results = fetch_sitemaps(
+                        list(dict.fromkeys(sitemap_urls)), executor, cache
+                    )
+            except requests.RequestException as e:
+                logging.error(f"Error requesting homepage: {str(e)}")
+
+        if workers > 1:
+            # Parsing large child sitemaps is CPU-bound, so spread it across
+            # processes; each builds its own session using the same cache.
+            # Every worker needs at least one request per period, so the pool
+            # is capped at the per-host budget to keep their sum within it
+            pool_size = min(workers, MAX_REQUESTS_PER_HOST)
+            if pool_size < workers:
+                logging.info(
+                    f"Using {pool_size} workers to stay within "
+                    f"{MAX_REQUESTS_PER_HOST} requests per host"
+                )
+            session = get_session()
+            cache_name = (
+                session.cache.cache_name
+                if CachedSession is not None and isinstance(session, CachedSession)
+                else None
+            )
+            with ProcessPoolExecutor(
+                max_workers=pool_size,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_worker,
+                initargs=(cache_name, MAX_REQUESTS_PER_HOST / pool_size),
+            ) as process_pool:
+                # The run's cache is not passed on: it would be pickled
+                # into every task and results could not flow back into it
+                all_results = expand_sitemap_indexes(
+                    all_results, max_depth, process_pool
                 )
-                if alt_response.status_code == 200:
-                    result = get_sitemap_content(alt_full_path, session, headers)
-                    if result:
-                        all_results.append({"url": alt_full_path, "content": result})
-        except requests.RequestException as e:
-            logging.error(f"Error requesting {full_path}: {str(e)}")
-
-        time.sleep(0.3)  # 0.3 second delay between requests
-
-    if not all_results:
-        try:
-            homepage_response = session.get(
-                base_url, headers=headers, allow_redirects=True, timeout=10
+        else:
+            all_results = expand_sitemap_indexes(
+                all_results, max_depth, executor, cache
             )
-            if homepage_response.status_code == 200:
-                sitemap_urls = find_sitemaps_in_html(homepage_response.text, base_url)
-                for sitemap_url in sitemap_urls:
-                    result = get_sitemap_content(sitemap_url, session, headers)
-                    if result:
-                        all_results.append({"url": sitemap_url, "content": result})
-        except requests.RequestException as e:
-            logging.error(f"Error requesting homepage: {str(e)}")
 
-    return all_results
+    # Different URLs can redirect to the same sitemap; report each one once
+    unique_results = {}
+    for result in all_results:
+        unique_results.setdefault(result["url"], result)
+    return list(unique_results.values())
 
 
-def get_sitemap_content(
-    url: str, session: requests.Session, headers: Dict[str, str]
-) -> Union[Dict[str, Union[str, List[str]]], None]:
+def probe_sitemap_path(base_url: str, alt_base_url: str, spath: str) -> List[str]:
+    full_path = urljoin(base_url, spath)
+    logging.info(f"Checking {full_path}")
     try:
-        response = session.get(url, headers=headers, timeout=10)
+        response = request_probe(full_path, spath)
+        logging.info(f"Got response {response.status_code}")
+
         if response.status_code == 200:
-            content = response.content
-            if (
-                url.endswith(".gz")
-                or response.headers.get("Content-Type") == "application/x-gzip"
-            ):
-                content = gzip.decompress(content)
-
-            root = ET.fromstring(content)
-
-            if root.tag.endswith("sitemapindex"):
-                sitemaps = [
-                    sitemap.text
-                    for sitemap in root.findall(
-                        ".//{http://www.sitemaps.org/schemas/sitemap/0.9}loc"
-                    )
-                ]
-                return {"type": "index", "sitemaps": sitemaps}
+            if spath == "robots.txt":
+                return parse_robots_txt(response.text)
+            return [response.url]
+        elif response.status_code == 403:
+            alt_full_path = urljoin(alt_base_url, spath)
+            logging.info(f"Trying alternative protocol: {alt_full_path}")
+            alt_response = request_probe(alt_full_path, spath)
+            if alt_response.status_code == 200:
+                return [alt_response.url]
+    except requests.RequestException as e:
+        logging.error(f"Error requesting {full_path}: {str(e)}")
+
+    return []
+
+
+def request_probe(url: str, spath: str) -> requests.Response:
+    # Sitemap bodies are fetched later, so a HEAD is enough to see whether
+    # the path exists; robots.txt is read right away and goes straight to GET
+    if spath != "robots.txt":
+        response = fetch(url, method="HEAD", allow_redirects=True, timeout=5)
+        if response.status_code not in (405, 501):
+            return response
+    return fetch(url, allow_redirects=True, timeout=10)
+
+
+def fetch_sitemaps(
+    sitemap_urls: List[str],
+    executor: Executor,
+    cache: Optional[Dict[str, Tuple[str, Dict[str, Union[str, List[str]]]]]] = None,
+) -> List[Dict[str, Union[str, Dict[str, List[str]]]]]:
+    fetched = executor.map(partial(get_sitemap_content, cache=cache), sitemap_urls)
+    return [{"url": url, "content": content} for url, content in fetched if content]
+
+
+def init_worker(cache_name: Optional[str], requests_per_host: float) -> None:
+    global _requests_per_host
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+    set_session(build_session(cache_name))
+    _requests_per_host = requests_per_host
+
+
+def expand_sitemap_indexes(
+    results: List[Dict[str, Union[str, Dict[str, List[str]]]]],
+    max_depth: int,
+    executor: Executor,
+    cache: Optional[Dict[str, Tuple[str, Dict[str, Union[str, List[str]]]]]] = None,
+) -> List[Dict[str, Union[str, Dict[str, List[str]]]]]:
+    # Breadth-first: every child of the current level is fetched at once, and
+    # the visited set keeps indexes that reference each other from looping
+    expanded = list(results)
+    visited = {result["url"] for result in results}
+    level = results
+    for _ in range(max_depth):
+        child_urls = [
+            url
+            for result in level
+            if result["content"]["type"] == "index"
+            for url in result["content"]["sitemaps"]
+        ]
+        child_urls = [url for url in dict.fromkeys(child_urls) if url not in visited]
+        if not child_urls:
+            break
+        visited.update(child_urls)
+        level = fetch_sitemaps(child_urls, executor, cache)
+        expanded.extend(level)
+    return expanded
+
+
+def get_sitemap_content(
+    url: str,
+    cache: Optional[Dict[str, Tuple[str, Dict[str, Union[str, List[str]]]]]] = None,
+) -> Tuple[str, Union[Dict[str, Union[str, List[str]]], None]]:
+    """Return the post-redirect URL of a sitemap and its parsed content."""
+    if cache is not None and url in cache:
+        return cache[url]
+
+    try:
+        with fetch(url, timeout=10, stream=True) as response:
+            # Another URL may already have redirected to this sitemap; the
+            # body has not been read yet, so the stream is just dropped
+            if cache is not None and response.url in cache:
+                cache[url] = cache[response.url]
+                return cache[url]
+            elif response.status_code == 200:
+                # iter_content undoes any Content-Encoding; only a .gz
+                # resource served as-is still needs decompressing
+                chunks = response.iter_content(CHUNK_SIZE)
+                if not response.headers.get("Content-Encoding") and (
+                    url.endswith(".gz")
+                    or response.headers.get("Content-Type") == "application/x-gzip"
+                ):
+                    chunks = gunzip_chunks(chunks)
+
+                stream = iter_sitemap(chunks)
+                sitemap_type = next(stream, None)
+                if sitemap_type is None:
+                    raise ValueError("no XML document could be recovered")
+
+                if sitemap_type == "index":
+                    content = {"type": "index", "sitemaps": list(stream)}
+                else:
+                    content = {"type": "sitemap", "urls": list(stream)}
             else:
-                urls = [
-                    url.text
-                    for url in root.findall(
-                        ".//{http://www.sitemaps.org/schemas/sitemap/0.9}loc"
-                    )
-                ]
-                return {"type": "sitemap", "urls": urls}
+                return response.url, None
+
+            if cache is not None:
+                cache[url] = cache[response.url] = (response.url, content)
+            return response.url, content
     except Exception as e:
         logging.error(f"Error processing sitemap at {url}: {str(e)}")
 
-    return None
+    return url, None
+
+
+def gunzip_chunks(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield decompressor.decompress(chunk)
+    yield decompressor.flush()
+
+
+def get_sitemap_type(root: ET._Element) -> str:
+    # The parser recovers from almost anything, so an HTML soft-404 still
+    # yields a document; only the two sitemap roots are accepted
+    if root.tag == _SITEMAPINDEX_TAG:
+        return "index"
+    if root.tag == _URLSET_TAG:
+        return "sitemap"
+    raise ValueError(f"not a sitemap, root element is <{root.tag}>")
+
+
+def iter_sitemap(chunks: Iterable[bytes]) -> Iterator[str]:
+    """Yield the sitemap type ("index" or "sitemap"), then each <loc> as it is parsed.
+
+    Chunks are fed to the parser as they arrive, so URLs are available before
+    the download finishes and memory stays bounded to the entry being parsed.
+    """
+    parser = ET.XMLPullParser(
+        events=("end",), tag=_LOC_TAG, recover=True, huge_tree=True
+    )
+    root = None
+
+    def read_batch() -> List[str]:
+        nonlocal root
+        batch = []
+        events = parser.read_events()
+        if root is None:
+            first = next(events, None)
+            if first is None:
+                return batch
+            root = first[1].getroottree().getroot()
+            batch.append(get_sitemap_type(root))
+            events = itertools.chain([first], events)
+        batch.extend([loc.text for _, loc in events if loc.text])
+        # Only the last entry can still be open, so everything before it is
+        # dropped with one slice delete per chunk rather than per <loc>
+        del root[:-1]
+        return batch
+
+    for chunk in chunks:
+        parser.feed(chunk)
+        yield from read_batch()
+    document = parser.close()
+    yield from read_batch()
+
+    if root is None and document is not None:
+        yield get_sitemap_type(document)
 
 
 def parse_robots_txt(robots_txt_content: str) -> List[str]:
-    return [
-        line.split(": ")[1].strip()
-        for line in robots_txt_content.split("\n")
-        if line.lower().startswith("sitemap:")
-    ]
+    return _ROBOTS_SITEMAP_RE.findall(robots_txt_content)
 
 
 def find_sitemaps_in_html(html_content: str, base_url: str) -> List[str]:
+    if LexborHTMLParser is None:
+        return [urljoin(base_url, m) for m in _HTML_SITEMAP_RE.findall(html_content)]
+
+    # <link rel="sitemap"> is taken as-is; plain links must name a sitemap file
+    # so that human-readable /sitemap pages are not fetched as XML
     sitemap_urls = []
-    for line in html_content.split("\n"):
-        for indicator in SITEMAP_INDICATORS:
-            if indicator in line:
-                start = line.find("http")
-                if start != -1:
-                    end = line.find('"', start)
-                    if end != -1:
-                        sitemap_urls.append(line[start:end])
-                else:
-                    start = line.find(indicator)
-                    if start != -1:
-                        end = line.find('"', start)
-                        if end != -1:
-                            sitemap_urls.append(urljoin(base_url, line[start:end]))
+    tree = LexborHTMLParser(html_content)
+    for node in tree.css('link[rel~="sitemap" i][href], a[href*="sitemap"]'):
+        href = node.attributes["href"]
+        if not href:
+            continue
+        href = href.strip()
+        if node.tag == "link" or urlparse(href).path.endswith(
+            tuple(SITEMAP_INDICATORS)
+        ):
+            sitemap_urls.append(urljoin(base_url, href))
     return sitemap_urls
 
 
@@ -177,21 +491,78 @@ def parse_arguments() -> argparse.Namespace:
         default=50,
         help="Maximum number of URLs to display per sitemap",
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "-c",
+        "--cache",
+        action="store_true",
+        help=f"Cache responses in {CACHE_NAME}.sqlite and revalidate them on reruns",
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        choices=["text", "json", "ndjson"],
+        default="text",
+        help="Output format; json and ndjson list every URL, ignoring the threshold",
+    )
+    parser.add_argument(
+        "-d",
+        "--max-depth",
+        type=int,
+        default=MAX_DEPTH,
+        help="Levels of nested sitemap indexes to follow (0 disables)",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="Processes used to fetch and parse child sitemaps (at most "
+        f"{MAX_REQUESTS_PER_HOST}, the per-host request budget)",
+    )
+    args = parser.parse_args()
+    if args.cache and CachedSession is None:
+        parser.error("--cache requires requests-cache (pip install requests-cache)")
+    return args
+
+
+def serialize_results(
+    results: List[Dict[str, Union[str, Dict[str, List[str]]]]], output_format: str
+) -> bytes:
+    if output_format == "json":
+        return orjson.dumps(results, option=orjson.OPT_APPEND_NEWLINE)
+
+    lines = []
+    for result in results:
+        content = result["content"]
+        locs = content["sitemaps"] if content["type"] == "index" else content["urls"]
+        lines.extend(
+            orjson.dumps(
+                {"sitemap": result["url"], "type": content["type"], "loc": loc},
+                option=orjson.OPT_APPEND_NEWLINE,
+            )
+            for loc in locs
+        )
+    return b"".join(lines)
 
 
 def main():
     args = parse_arguments()
     base_url = args.url
     threshold = args.threshold
+    max_depth = args.max_depth
+    workers = args.workers
 
-    logging.basicConfig(
-        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
-    )
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+
+    if args.cache:
+        set_session(build_session(CACHE_NAME))
 
-    results = get_sitemaps_from_url(base_url, threshold)
+    results = get_sitemaps_from_url(base_url, threshold, max_depth, workers)
 
-    if results:
+    if args.format != "text":
+        # One buffered write of the complete results instead of a print per URL
+        sys.stdout.buffer.write(serialize_results(results, args.format))
+    elif results:
         print(f"\nFound {len(results)} sitemap(s):")
         for i, result in enumerate(results, 1):
             print(f"\n{i}. Sitemap URL: {result['url']}")